@@ -1,14 +1,43 @@
 """Initramfs building utilities."""
 
+import functools
+import gzip
 import logging
+import lzma
 import os
+import re
+import shutil
+import stat
+import struct
 import subprocess
-import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import BinaryIO
 
 logger = logging.getLogger("kdf.initramfs")
 
+# cpio "newc" (SVR4 without CRC) format, as expected by the kernel
+CPIO_NEWC_MAGIC = b"070701"
+CPIO_TRAILER = "TRAILER!!!"
 
+# Dependencies parsed from module .modinfo sections, by resolved module path
+_modinfo_depends_cache: dict[Path, tuple[str, ...]] = {}
+
+# Kernel module extension with optional compression, e.g. ".ko" or ".ko.xz"
+_MOD_SUFFIX_RE = re.compile(r"\.ko(?:\.(?P<compression>xz|gz))?$")
+
+
+def path_exists(path: Path) -> bool:
+    """Check whether path exists using access(2), which is cheaper than stat(2).
+
+    Like Path.exists(), symlinks are followed, so a broken symlink does not exist.
+    """
+    return os.access(path, os.F_OK)
+
+
+@functools.cache
 def get_resource_dir() -> Path | None:
     """Get resource directory if running from Nix package, None otherwise."""
     resource_dir = os.environ.get("KDF_RESOURCE_DIR")
@@ -17,87 +46,376 @@ def get_resource_dir() -> Path | None:
     return None
 
 
+@functools.cache
 def get_prebuilt_initramfs() -> Path | None:
     """Get path to prebuilt initramfs if available."""
     resource_dir = get_resource_dir()
     if resource_dir:
         initramfs_path = resource_dir / "initramfs.cpio"
-        if initramfs_path.exists():
+        if path_exists(initramfs_path):
             return initramfs_path
     return None
 
 
+@functools.cache
 def get_prebuilt_init() -> Path | None:
     """Get path to prebuilt kdf-init binary if available."""
     resource_dir = get_resource_dir()
     if resource_dir:
         init_path = resource_dir / "init"
-        if init_path.exists():
+        if path_exists(init_path):
             return init_path
     return None
 
 
 def copy_file(src: Path, dst: Path) -> None:
     """Copy file from src to dst."""
-    subprocess.run(["cp", str(src), str(dst)], check=True)
+    shutil.copyfile(src, dst)
+
+
+def open_module(module_path: Path) -> BinaryIO:
+    """Open a kernel module for reading, transparently decompressing .xz/.gz."""
+    match = _MOD_SUFFIX_RE.search(module_path.name)
+    compression = match.group("compression") if match else None
+    if compression == "xz":
+        return lzma.open(module_path, "rb")
+    if compression == "gz":
+        return gzip.open(module_path, "rb")
+    return module_path.open("rb")
+
+
+def _split_depends(deps: str) -> list[str]:
+    """Split a comma-separated modinfo depends value into module names."""
+    return [d.strip() for d in deps.split(",") if d.strip()]
+
 
+def _find_elf_section(data: bytes, section_name: bytes) -> bytes | None:
+    """Return the contents of the named ELF section, or None if not found."""
+    if data[:4] != b"\x7fELF":
+        return None
 
-def get_module_dependencies(module_path: Path) -> list[str]:
-    """Get module dependencies using modinfo."""
+    try:
+        endian = "<" if data[5] == 1 else ">"
+        if data[4] == 2:  # ELF64
+            (shoff,) = struct.unpack_from(endian + "Q", data, 0x28)
+            shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x3A)
+            header_fmt = endian + "IIQQQQ"
+        elif data[4] == 1:  # ELF32
+            (shoff,) = struct.unpack_from(endian + "I", data, 0x20)
+            shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x2E)
+            header_fmt = endian + "IIIIII"
+        else:
+            return None
+
+        # (sh_name, sh_offset, sh_size) for every section header
+        sections = []
+        for i in range(shnum):
+            header = struct.unpack_from(header_fmt, data, shoff + i * shentsize)
+            sections.append((header[0], header[4], header[5]))
+    except (struct.error, IndexError):
+        return None
+
+    if shstrndx >= len(sections):
+        return None
+    _, strtab_offset, strtab_size = sections[shstrndx]
+    strtab = data[strtab_offset : strtab_offset + strtab_size]
+
+    for name_offset, offset, size in sections:
+        name_end = strtab.find(b"\0", name_offset)
+        if strtab[name_offset:name_end] == section_name:
+            return data[offset : offset + size]
+    return None
+
+
+def _read_modinfo_depends(data: bytes) -> tuple[str, ...] | None:
+    """Read the depends= field from a module's .modinfo ELF section.
+
+    Args:
+        data: Decompressed module contents
+
+    Returns:
+        Tuple of dependency names, or None if the module could not be parsed
+
+    """
+    modinfo = _find_elf_section(data, b".modinfo")
+    if modinfo is None:
+        return None
+
+    for entry in modinfo.split(b"\0"):
+        if entry.startswith(b"depends="):
+            return tuple(_split_depends(entry.removeprefix(b"depends=").decode()))
+    return ()
+
+
+def _modinfo_depends(module_paths: list[Path]) -> list[list[str]]:
+    """Get module dependencies for several modules with a single modinfo call."""
     try:
         result = subprocess.run(
-            ["modinfo", "-F", "depends", str(module_path)],
+            ["modinfo", "-F", "depends", *(str(p) for p in module_paths)],
             capture_output=True,
             text=True,
             check=True,
         )
-        deps = result.stdout.strip()
-        if deps:
-            return [d.strip() for d in deps.split(",") if d.strip()]
-        return []
     except subprocess.CalledProcessError:
-        return []
+        return [[] for _ in module_paths]
+
+    # modinfo prints one (possibly empty) line per module, in argument order
+    lines = result.stdout.splitlines()
+    if len(lines) != len(module_paths):
+        return [[] for _ in module_paths]
+    return [_split_depends(line) for line in lines]
+
+
+def _try_read_module(module_path: Path) -> bytes | None:
+    """Read and decompress a module, or return None if that fails."""
+    try:
+        with open_module(module_path) as f:
+            return f.read()
+    except (OSError, EOFError, lzma.LZMAError, zlib.error):
+        return None
+
+
+def get_module_dependencies(
+    module_paths: list[Path],
+    contents: dict[Path, bytes] | None = None,
+) -> list[list[str]]:
+    """Get dependencies for each module, in the same order as module_paths.
+
+    Dependencies are read directly from each module's .modinfo section;
+    modules that cannot be parsed fall back to one batched modinfo call.
+    Parsed results are cached by resolved module path.
 
+    Args:
+        module_paths: Kernel module paths
+        contents: Optional already-decompressed module contents by path,
+            to avoid reading and decompressing the modules again
 
-def topological_sort_modules(modules: list[Path]) -> list[Path]:
-    """Sort modules in dependency order using topological sort."""
+    Returns:
+        List of dependency names for each module
+
+    """
+    deps: list[list[str] | None] = []
+    for module_path in module_paths:
+        key = module_path.resolve()
+        parsed = _modinfo_depends_cache.get(key)
+        if parsed is None:
+            data = (contents or {}).get(module_path)
+            if data is None:
+                data = _try_read_module(module_path)
+            parsed = None if data is None else _read_modinfo_depends(data)
+            if parsed is not None:
+                _modinfo_depends_cache[key] = parsed
+        deps.append(None if parsed is None else list(parsed))
+
+    unparsed = [i for i, d in enumerate(deps) if d is None]
+    if unparsed:
+        fallback = _modinfo_depends([module_paths[i] for i in unparsed])
+        for i, d in zip(unparsed, fallback, strict=True):
+            deps[i] = d
+
+    return [d or [] for d in deps]
+
+
+def topological_sort_modules(
+    modules: list[Path],
+    *,
+    deps: dict[str, list[str]] | None = None,
+    contents: dict[Path, bytes] | None = None,
+) -> list[Path]:
+    """Sort modules in dependency order using topological sort.
+
+    Args:
+        modules: Kernel module paths to sort
+        deps: Optional mapping of module name (without .ko) to dependency
+            names. Modules listed here are not inspected for dependencies.
+        contents: Optional already-decompressed module contents by path
+
+    Returns:
+        Module paths ordered so that dependencies come first
+
+    """
     # Build dependency graph
     module_map = {}  # name (without .ko.xz) -> Path
-    dependencies = {}  # name -> list of dependency names
 
     for module_path in modules:
-        name = module_path.name
-        # Remove compression extensions
-        name = name.removesuffix(".xz")
-        name = name.removesuffix(".gz")
-        # Remove .ko extension
-        name = name.removesuffix(".ko")
-
+        # Remove .ko and compression extensions
+        name = _MOD_SUFFIX_RE.sub("", module_path.name)
         module_map[name] = module_path
-        dependencies[name] = get_module_dependencies(module_path)
 
-    # Topological sort
+    # name -> list of dependency names. Modules not covered by deps have
+    # their dependencies read from the modules themselves.
+    known = deps or {}
+    unknown = [name for name in module_map if name not in known]
+    if deps is not None and unknown:
+        logger.warning(
+            "No declared dependencies for %s, reading them from the modules",
+            ", ".join(unknown),
+        )
+    read: dict[str, list[str]] = {}
+    if unknown:
+        read = dict(
+            zip(
+                unknown,
+                get_module_dependencies([module_map[n] for n in unknown], contents),
+                strict=True,
+            )
+        )
+    dependencies = {
+        name: known[name] if name in known else read[name] for name in module_map
+    }
+
+    # Topological sort (Kahn's algorithm). Edges point from a dependency to
+    # the modules that need it; dependencies we don't have are ignored.
+    dependents: dict[str, list[str]] = {name: [] for name in module_map}
+    indegree = dict.fromkeys(module_map, 0)
+    for name, module_deps in dependencies.items():
+        for dep in dict.fromkeys(module_deps):  # Deduplicate, keeping order
+            if dep in dependents:
+                dependents[dep].append(name)
+                indegree[name] += 1
+
     sorted_modules = []
-    visited = set()
+    queue = deque(name for name, count in indegree.items() if count == 0)
+    while queue:
+        name = queue.popleft()
+        sorted_modules.append(module_map[name])
+        for dependent in dependents[name]:
+            indegree[dependent] -= 1
+            if indegree[dependent] == 0:
+                queue.append(dependent)
 
-    def visit(name: str) -> None:
-        if name in visited:
-            return
-        visited.add(name)
+    # Modules in a dependency cycle never reach in-degree zero; keep them
+    # (in input order) rather than dropping them from the archive
+    if len(sorted_modules) < len(module_map):
+        cyclic = [module_map[name] for name, count in indegree.items() if count > 0]
+        logger.warning(
+            "Dependency cycle between modules: %s",
+            ", ".join(mod.name for mod in cyclic),
+        )
+        sorted_modules.extend(cyclic)
 
-        # Visit dependencies first
-        for dep in dependencies.get(name, []):
-            if dep in module_map:  # Only if we have this dependency
-                visit(dep)
+    return sorted_modules
 
-        if name in module_map:
-            sorted_modules.append(module_map[name])
 
-    # Visit all modules
-    for name in module_map:
-        visit(name)
+def _read_module(module_path: Path) -> bytes:
+    """Read a kernel module into memory, decompressing .xz/.gz modules."""
+    if not path_exists(module_path):
+        msg = f"Kernel module not found: {module_path}"
+        raise FileNotFoundError(msg)
 
-    return sorted_modules
+    with open_module(module_path) as f:
+        return f.read()
+
+
+def _write_newc_entry(
+    out: BinaryIO,
+    ino: int,
+    name: str,
+    mode: int,
+    data: bytes = b"",
+) -> None:
+    """Write a single cpio entry in the "newc" format.
+
+    Header and name are padded to a 4-byte boundary, as is the file data.
+
+    Args:
+        out: Output stream
+        ino: Inode number (must be unique within the archive)
+        name: Path of the entry inside the archive
+        mode: File type and permission bits (e.g., stat.S_IFREG | 0o755)
+        data: File contents (empty for directories and the trailer)
+
+    """
+    name_bytes = name.encode() + b"\0"
+    nlink = 2 if stat.S_ISDIR(mode) else 1
+    fields = (ino, mode, 0, 0, nlink, 0, len(data), 0, 0, 0, 0, len(name_bytes), 0)
+    header = CPIO_NEWC_MAGIC + b"".join(b"%08X" % field for field in fields)
+
+    out.write(header + name_bytes)
+    out.write(b"\0" * (-(len(header) + len(name_bytes)) % 4))
+    out.write(data)
+    out.write(b"\0" * (-len(data) % 4))
+
+
+def _collect_initramfs_entries(
+    init_binary: Path,
+    modules: list[Path],
+    moddir: str,
+    *,
+    deps: dict[str, list[str]] | None = None,
+) -> list[tuple[str, int, bytes]]:
+    """Read init binary and modules into (name, mode, data) archive entries."""
+    entries: list[tuple[str, int, bytes]] = [
+        ("init", stat.S_IFREG | 0o755, init_binary.read_bytes()),
+    ]
+
+    # Add kernel modules if provided
+    if modules:
+        # Decompress every module once; the data is used both for dependency
+        # resolution and for the archive itself
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            contents = dict(
+                zip(modules, executor.map(_read_module, modules), strict=True)
+            )
+
+        # Sort modules by dependencies
+        sorted_modules = topological_sort_modules(modules, deps=deps, contents=contents)
+        logger.info(
+            "Module load order after dependency resolution:\n%s",
+            "\n".join(
+                f"  {idx}. {mod.name}" for idx, mod in enumerate(sorted_modules, 1)
+            ),
+        )
+
+        # Create every directory leading up to the module directory
+        moddir_relative = Path(moddir.lstrip("/"))
+        entries.extend(
+            (str(parent), stat.S_IFDIR | 0o755, b"")
+            for parent in [*reversed(moddir_relative.parents[:-1]), moddir_relative]
+        )
+
+        added = []
+        for idx, module_path in enumerate(sorted_modules):
+            # Add numeric prefix for load order: 00-, 01-, etc.
+            module_name = module_path.name
+            decompressed_name = _MOD_SUFFIX_RE.sub(".ko", module_name)
+            final_name = f"{idx:02d}-{decompressed_name}"
+            entries.append(
+                (
+                    str(moddir_relative / final_name),
+                    stat.S_IFREG | 0o644,
+                    contents[module_path],
+                )
+            )
+            added.append(f"  {module_name} -> {final_name}")
+
+        logger.info("Added modules:\n%s", "\n".join(added))
+
+    return entries
+
+
+def _write_newc_archive(out: BinaryIO, entries: list[tuple[str, int, bytes]]) -> None:
+    """Write (name, mode, data) entries as a newc cpio archive."""
+    for ino, (name, mode, data) in enumerate(entries, 1):
+        _write_newc_entry(out, ino, name, mode, data)
+    _write_newc_entry(out, 0, CPIO_TRAILER, 0)
+
+
+def write_initramfs_archive(
+    out: BinaryIO,
+    init_binary: Path,
+    modules: list[Path],
+    moddir: str,
+    *,
+    deps: dict[str, list[str]] | None = None,
+) -> None:
+    """Write initramfs cpio archive for init binary and modules to a stream.
+
+    If deps is given, it is used as the module dependency graph instead of
+    reading each module's modinfo (see topological_sort_modules).
+    """
+    entries = _collect_initramfs_entries(init_binary, modules, moddir, deps=deps)
+    _write_newc_archive(out, entries)
 
 
 def create_initramfs_archive(
@@ -105,75 +423,12 @@ def create_initramfs_archive(
     output_path: Path,
     modules: list[Path],
     moddir: str,
+    *,
+    deps: dict[str, list[str]] | None = None,
 ) -> None:
     """Create initramfs cpio archive from init binary and optional kernel modules."""
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmppath = Path(tmpdir)
-
-        # Copy init binary to temp directory
-        init_path = tmppath / "init"
-        copy_file(init_binary, init_path)
-        subprocess.run(["chmod", "+x", str(init_path)], check=True)
-
-        # Copy kernel modules if provided
-        if modules:
-            # Sort modules by dependencies
-            sorted_modules = topological_sort_modules(modules)
-            logger.info("Module load order after dependency resolution:")
-            for idx, mod in enumerate(sorted_modules, 1):
-                logger.info("  %s. %s", idx, mod.name)
-
-            # Strip leading slash for creating directory in tmpdir
-            moddir_relative = moddir.lstrip("/")
-            modules_dir = tmppath / moddir_relative
-            modules_dir.mkdir(parents=True, exist_ok=True)
-
-            for idx, module_path in enumerate(sorted_modules):
-                if not module_path.exists():
-                    msg = f"Kernel module not found: {module_path}"
-                    raise FileNotFoundError(msg)
-
-                # Decompress if needed and add numeric prefix for load order
-                module_name = module_path.name
-                prefix = f"{idx:02d}-"  # Two-digit prefix: 00-, 01-, etc.
-
-                if module_name.endswith(".xz"):
-                    # Decompress .xz module
-                    decompressed_name = module_name[:-3]  # Remove .xz extension
-                    final_name = prefix + decompressed_name
-                    module_dest = modules_dir / final_name
-                    with module_dest.open("wb") as dest_file:
-                        subprocess.run(
-                            ["xz", "-dc", str(module_path)],
-                            stdout=dest_file,
-                            check=True,
-                        )
-                    logger.info("Added module: %s -> %s", module_name, final_name)
-                elif module_name.endswith(".gz"):
-                    # Decompress .gz module
-                    decompressed_name = module_name[:-3]  # Remove .gz extension
-                    final_name = prefix + decompressed_name
-                    module_dest = modules_dir / final_name
-                    with module_dest.open("wb") as dest_file:
-                        subprocess.run(
-                            ["gzip", "-dc", str(module_path)],
-                            stdout=dest_file,
-                            check=True,
-                        )
-                    logger.info("Added module: %s -> %s", module_name, final_name)
-                else:
-                    # Copy as-is
-                    final_name = prefix + module_name
-                    module_dest = modules_dir / final_name
-                    copy_file(module_path, module_dest)
-                    logger.info("Added module: %s -> %s", module_name, final_name)
-
-        # Create cpio archive
-        with output_path.open("wb") as f:
-            subprocess.run(
-                "find . -print0 | cpio --null -o -H newc",
-                cwd=tmpdir,
-                shell=True,
-                stdout=f,
-                check=True,
-            )
+    # Read and decompress everything before opening (and truncating) the output,
+    # so a missing or corrupt module leaves any existing archive untouched
+    entries = _collect_initramfs_entries(init_binary, modules, moddir, deps=deps)
+    with output_path.open("wb") as f:
+        _write_newc_archive(f, entries)
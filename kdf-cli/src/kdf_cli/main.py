@@ -13,6 +13,7 @@ from kdf_cli.initramfs import (
     create_initramfs_archive,
     get_prebuilt_init,
     get_prebuilt_initramfs,
+    path_exists,
 )
 from kdf_cli.nix import resolve_kernel_and_initramfs
 from kdf_cli.qemu import QemuCommand
@@ -64,7 +65,7 @@ def cmd_build_initramfs(args: argparse.Namespace) -> None:
             logger.info("Using prebuilt init binary: %s", prebuilt_init)
             init_binary = prebuilt_init
         else:
-            if not args.init_binary.exists():
+            if not path_exists(args.init_binary):
                 msg = f"Init binary not found: {args.init_binary}"
                 raise FileNotFoundError(msg)
             init_binary = args.init_binary
@@ -102,7 +103,7 @@ def _resolve_kernel_and_initramfs(args: argparse.Namespace) -> tuple[Path, Path]
 
     # Use provided kernel
     kernel = args.kernel
-    if not kernel.exists():
+    if not path_exists(kernel):
         logger.error("Kernel not found: %s", kernel)
         sys.exit(1)
 
@@ -124,7 +125,7 @@ def _resolve_kernel_and_initramfs(args: argparse.Namespace) -> tuple[Path, Path]
         initramfs = prebuilt_initramfs  # type: ignore[invalid-assignment]
         logger.info("Using prebuilt initramfs: %s", initramfs)
 
-    if not initramfs.exists():
+    if not path_exists(initramfs):
         logger.error("Initramfs not found: %s", initramfs)
         sys.exit(1)
 
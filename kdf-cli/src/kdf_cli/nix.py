@@ -1,11 +1,22 @@
 """Nix integration for kernel resolution."""
 
+import functools
+import hashlib
+import json
 import logging
+import os
 import subprocess
 import tempfile
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from kdf_cli.initramfs import create_initramfs_archive, get_prebuilt_init
+from kdf_cli.initramfs import (
+    get_prebuilt_init,
+    path_exists,
+    write_initramfs_archive,
+)
 
 logger = logging.getLogger("kdf.nix")
 
@@ -21,13 +32,172 @@ VIRTIOFS_MODULES = [
     "fs/fuse/virtiofs.ko",
 ]
 
-
+# Dependencies between VIRTIOFS_MODULES, by module name (as in modinfo depends=).
+# Keep in sync with VIRTIOFS_MODULES so the initramfs build can skip modinfo.
+VIRTIOFS_MODULE_DEPS = {
+    "virtio": [],
+    "virtio_ring": [],
+    "virtio_pci_modern_dev": [],
+    "virtio_pci_legacy_dev": [],
+    "virtio_pci": [
+        "virtio_pci_legacy_dev",
+        "virtio_pci_modern_dev",
+        "virtio",
+        "virtio_ring",
+    ],
+    "fuse": [],
+    "virtiofs": ["fuse", "virtio", "virtio_ring"],
+}
+
+if VIRTIOFS_MODULE_DEPS.keys() != {
+    Path(module).name.removesuffix(".ko") for module in VIRTIOFS_MODULES
+}:
+    msg = "VIRTIOFS_MODULE_DEPS is out of sync with VIRTIOFS_MODULES"
+    raise RuntimeError(msg)
+
+
+@functools.cache
 def get_system_kernel_version() -> str:
-    """Get the current system kernel version using uname."""
-    result = subprocess.run(["uname", "-r"], capture_output=True, text=True, check=True)
-    return result.stdout.strip()
+    """Get the current system kernel version (as reported by uname -r)."""
+    return os.uname().release
+
+
+# Store paths are immutable, so only evaluations rooted there can be cached
+NIX_STORE_DIR = Path("/nix/store")
+
+# Serializes read-modify-write of the resolve cache between concurrent builds
+_resolve_cache_lock = threading.Lock()
+
+
+def get_resolve_cache_path() -> Path:
+    """Get the path of the on-disk cache of resolved Nix store paths."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "kdf" / "nix-resolve.json"
+
+
+def _nixpkgs_user_config_paths() -> list[Path]:
+    """List the user config and overlay locations `import <nixpkgs> {}` reads."""
+    config_home = Path(os.environ.get("XDG_CONFIG_HOME") or Path.home() / ".config")
+    candidates = [
+        config_home / "nixpkgs" / "config.nix",
+        config_home / "nixpkgs" / "overlays.nix",
+        config_home / "nixpkgs" / "overlays",
+        Path.home() / ".config" / "nixpkgs" / "config.nix",
+        Path.home() / ".config" / "nixpkgs" / "overlays.nix",
+        Path.home() / ".config" / "nixpkgs" / "overlays",
+        Path.home() / ".nixpkgs" / "config.nix",
+    ]
+    return list(dict.fromkeys(candidates))  # Deduplicate when XDG is the default
+
+
+def _nix_path_fingerprint() -> list[str] | None:
+    """Describe which nixpkgs `import <nixpkgs> {}` currently evaluates.
+
+    Caching is only safe when evaluation inputs are immutable, so this
+    returns None (bypassing the cache) unless <nixpkgs> resolves through
+    NIX_PATH into the Nix store and no user nixpkgs config or overlays are
+    in play. Channels are symlinks into the store, so updating a channel
+    changes the resolved target and therefore the fingerprint.
+    """
+    if os.environ.get("NIXPKGS_CONFIG") or any(
+        path_exists(path) for path in _nixpkgs_user_config_paths()
+    ):
+        return None
+
+    # Without NIX_PATH, nix falls back to the nix-path setting in nix.conf,
+    # which may be a flake registry entry or a local checkout
+    nix_path = os.environ.get("NIX_PATH")
+    if not nix_path or any(
+        scheme in nix_path for scheme in ("://", "channel:", "flake:")
+    ):
+        return None
+
+    fingerprint = []
+    for entry in filter(None, nix_path.split(":")):
+        prefix, sep, path = entry.partition("=")
+        if not sep:
+            prefix, path = "", entry
+        elif prefix != "nixpkgs" and not prefix.startswith("nixpkgs/"):
+            continue  # e.g. nixos-config=..., never consulted for <nixpkgs>
+
+        # An unprefixed entry answers <nixpkgs> through its nixpkgs subdirectory
+        candidate = Path(path) / "nixpkgs" if not prefix else Path(path)
+        if not path_exists(candidate):
+            # Nix skips this entry; record it so the key changes if it appears
+            fingerprint.append(f"{entry}@missing")
+            continue
+
+        resolved = candidate.resolve()
+        if not resolved.is_relative_to(NIX_STORE_DIR):
+            return None
+        fingerprint.append(f"{prefix}={resolved}")
+        if prefix in {"", "nixpkgs"}:
+            return fingerprint  # The first entry that answers <nixpkgs> wins
+
+    # Nothing in NIX_PATH answers <nixpkgs>, so nix would fall back to nix.conf
+    return None
+
+
+def _load_resolve_cache() -> dict[str, str]:
+    """Load the resolve cache, returning an empty cache if it is unreadable."""
+    try:
+        cache = json.loads(get_resolve_cache_path().read_text())
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _store_resolve_cache(key: str, store_path: str) -> None:
+    """Add an entry to the resolve cache, dropping garbage-collected paths."""
+    cache_path = get_resolve_cache_path()
+    with _resolve_cache_lock:
+        cache = {k: v for k, v in _load_resolve_cache().items() if path_exists(Path(v))}
+        cache[key] = store_path
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w",
+                dir=cache_path.parent,
+                prefix=".nix-resolve-",
+                delete=False,
+            ) as f:
+                json.dump(cache, f)
+            Path(f.name).replace(cache_path)
+        except OSError as e:
+            logger.debug("Failed to write resolve cache %s: %s", cache_path, e)
+
+
+def _cache_store_path(
+    build: Callable[[str, str | None], str],
+) -> Callable[[str, str | None], str]:
+    """Cache store paths returned by a Nix build function on disk.
+
+    Entries are keyed by expression, output and the resolved nixpkgs
+    channels, and are only reused while the store path still exists.
+    """
+
+    @functools.wraps(build)
+    def wrapper(nix_expr: str, output: str | None = None) -> str:
+        fingerprint = _nix_path_fingerprint()
+        if fingerprint is None:
+            return build(nix_expr, output)
+
+        key = hashlib.sha256(
+            json.dumps([nix_expr, output, fingerprint]).encode(),
+        ).hexdigest()
+        cached = _load_resolve_cache().get(key)
+        if cached is not None and path_exists(Path(cached)):
+            logger.debug("Using cached store path for %s: %s", nix_expr, cached)
+            return cached
 
+        store_path = build(nix_expr, output)
+        _store_resolve_cache(key, store_path)
+        return store_path
 
+    return wrapper
+
+
+@_cache_store_path
 def nix_build_output(nix_expr: str, output: str | None = None) -> str:
     """Build a Nix expression and return the output path.
 
@@ -87,11 +257,13 @@ def get_kernel_derivations(version: str | None = None) -> tuple[str, str]:
         logger.info("Using %s from nixpkgs", package_name)
 
     try:
-        # Build kernel (default output)
-        kernel_drv = nix_build_output(nix_expr)
-
-        # Build modules output
-        modules_drv = nix_build_output(nix_expr, "modules")
+        # Build kernel (default output) and modules output concurrently;
+        # evaluation dominates even when both are already in the store
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            kernel_future = executor.submit(nix_build_output, nix_expr)
+            modules_future = executor.submit(nix_build_output, nix_expr, "modules")
+            kernel_drv = kernel_future.result()
+            modules_drv = modules_future.result()
 
         logger.info("Kernel derivation: %s", kernel_drv)
         logger.info("Modules derivation: %s", modules_drv)
@@ -115,17 +287,34 @@ def get_kernel_image_path(kernel_drv: str) -> Path:
     """
     kernel_path = Path(kernel_drv)
 
+    msg = f"Could not find kernel image in {kernel_path}"
+
+    # List the derivation once instead of probing each candidate name
+    try:
+        with os.scandir(kernel_path) as it:
+            present = {entry.name for entry in it}
+    except OSError as e:
+        raise FileNotFoundError(msg) from e
+
     # Try common kernel image names
     for image_name in ["bzImage", "Image", "vmlinuz", "zImage"]:
-        kernel_image = kernel_path / image_name
-        if kernel_image.exists():
+        if image_name in present:
+            kernel_image = kernel_path / image_name
             logger.info("Found kernel image: %s", kernel_image)
             return kernel_image
 
-    msg = f"Could not find kernel image in {kernel_path}"
     raise FileNotFoundError(msg)
 
 
+def _list_dir(path: Path) -> set[str]:
+    """List entry names in a directory, or an empty set if it cannot be read."""
+    try:
+        with os.scandir(path) as it:
+            return {entry.name for entry in it}
+    except OSError:
+        return set()
+
+
 def find_modules(modules_drv: str, module_patterns: list[str]) -> list[Path]:
     """Find kernel modules in the kernel modules directory.
 
@@ -151,21 +340,33 @@ def find_modules(modules_drv: str, module_patterns: list[str]) -> list[Path]:
     kernel_dir = kernel_dirs[0]
     kernel_base = kernel_dir / "kernel"
 
+    # List each directory holding a requested module once, instead of
+    # probing every pattern/extension combination with its own stat
+    listings = {
+        parent: _list_dir(parent)
+        for parent in dict.fromkeys((kernel_base / p).parent for p in module_patterns)
+    }
+
     for pattern in module_patterns:
+        pattern_path = kernel_base / pattern
+        present = listings[pattern_path.parent]
+
         # Try with compression extensions
-        found = False
-        for ext in [".xz", ".gz", ""]:
-            module_path = Path(str(kernel_base / pattern) + ext)
-            if module_path.exists():
-                modules.append(module_path)
-                logger.info("Found module: %s", module_path)
-                found = True
-                break
-
-        if not found:
+        module_name = next(
+            (
+                pattern_path.name + ext
+                for ext in [".xz", ".gz", ""]
+                if pattern_path.name + ext in present
+            ),
+            None,
+        )
+        if module_name is None:
             msg = f"Could not find module {pattern} in {kernel_base}"
             raise FileNotFoundError(msg)
 
+        modules.append(pattern_path.parent / module_name)
+
+    logger.info("Found modules:\n%s", "\n".join(f"  {module}" for module in modules))
     return modules
 
 
@@ -245,14 +446,15 @@ def resolve_kernel_and_initramfs(
     # Find virtiofs modules
     modules = find_modules(modules_drv, VIRTIOFS_MODULES)
 
-    # Create temporary initramfs file
-    import os
-
+    # Create temporary initramfs file and write the archive through the
+    # descriptor mkstemp already opened, rather than reopening it by path
     fd, initramfs_tmpfile = tempfile.mkstemp(suffix=".cpio", prefix="kdf-initramfs-")
-    os.close(fd)  # Close the file descriptor, we just need the path
     initramfs_path = Path(initramfs_tmpfile)
 
     logger.info("Building initramfs with %d virtiofs modules", len(modules))
-    create_initramfs_archive(init_binary, initramfs_path, modules, "/init-modules")
+    with os.fdopen(fd, "wb") as f:
+        write_initramfs_archive(
+            f, init_binary, modules, "/init-modules", deps=VIRTIOFS_MODULE_DEPS
+        )
 
     return kernel_image, initramfs_path
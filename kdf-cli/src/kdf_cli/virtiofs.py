@@ -115,8 +115,11 @@ class Virtiofsd(BackgroundTask):
 
         # Start thread to read and log virtiofsd output
         def log_output(pipe: IO[str], prefix: str) -> None:
-            for line in pipe:
-                logger.info("[virtiofsd:%s] %s: %s", self.tag, prefix, line.rstrip())
+            with pipe:
+                for line in pipe:
+                    logger.info(
+                        "[virtiofsd:%s] %s: %s", self.tag, prefix, line.rstrip()
+                    )
 
         self.log_thread_stdout = threading.Thread(
             target=log_output,